@@ -1,88 +1,116 @@
 from lxml import etree
+import io
 import sys
 
+# compile xpath expression once, binding the prop key as a variable
+_PROP_XPATH = etree.XPath('(.//prop[@k=$k])[1]/@v', smart_strings=False)
+
 def process_file(f):
-    print('XXX: Processing file: {0}'.format(f))
+    # buffer output and write it out once at the end
+    out = io.StringIO()
+
+    print('XXX: Processing file: {0}'.format(f), file=out)
     basename = f[8:-4]
-    print('.{0} {{'.format(basename))
+    print('.{0} {{'.format(basename), file=out)
 
-    # open file
-    tree = etree.parse(f)
-    root = tree.getroot()
+    # stream file, only keeping the elements still to be processed
+    context = etree.iterparse(f, events=('start', 'end'), tag=('renderer-v2', 'category', 'symbol'))
 
-    # read attr
-    renderer = root.findall('.//renderer-v2')[0]
+    # read attr as soon as the renderer starts
+    renderer = next(elem for event, elem in context if elem.tag == 'renderer-v2')
     if renderer.attrib['type'] == 'categorizedSymbol':
         attr = renderer.attrib['attr']
-        process_categorizedSymbol(renderer, attr)
+        process_categorizedSymbol(context, renderer, attr, out)
     elif renderer.attrib['type'] == 'singleSymbol':
-        process_singleSymbol(root)
+        process_singleSymbol(context, renderer, out)
     else:
-        print('XXX: unknown type')
-
-    print('}')
-
-def process_categorizedSymbol(renderer, attr):
+        print('XXX: unknown type', file=out)
+
+    print('}', file=out)
+    sys.stdout.write(out.getvalue())
+
+def iter_renderer_children(context, renderer):
+    # yield each category and symbol of the renderer once it is fully parsed,
+    # then free it along with any siblings already processed
+    for event, elem in context:
+        if elem is renderer:
+            return
+        parent = elem.getparent()
+        if event == 'end' and parent.tag in ('categories', 'symbols') and parent.getparent() is renderer:
+            yield elem
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+def process_categorizedSymbol(context, renderer, attr, out):
     # attr we look at to determine styles
     # attr -> value: category
 
-    for category in renderer.findall('.//categories//category'):
-        symbol_name = category.attrib['symbol']
-        value = category.attrib['value']
-
-        query = './/symbols//symbol[@name="{0}"]'.format(symbol_name)
-        for symbol in renderer.findall(query):
-            print('  [{0}="{1}"] {{'.format(attr, value))
-            process_symbol(symbol)
-            print('  }')
-
-def process_singleSymbol(renderer):
-    symbol = renderer.findall('.//symbol')[0]
-    process_symbol(symbol)
-
-def process_symbol(symbol):
-    layer = symbol.findall('.//layer')[0]
+    categories = []
+    symbols = {}
+    for elem in iter_renderer_children(context, renderer):
+        if elem.tag == 'category':
+            categories.append((elem.attrib['value'], elem.attrib['symbol']))
+        else:
+            symbol_out = io.StringIO()
+            process_symbol(elem, symbol_out)
+            symbols.setdefault(elem.attrib['name'], []).append(symbol_out.getvalue())
+
+    for value, symbol_name in categories:
+        for symbol in symbols.get(symbol_name, []):
+            print('  [{0}="{1}"] {{'.format(attr, value), file=out)
+            out.write(symbol)
+            print('  }', file=out)
+
+def process_singleSymbol(context, renderer, out):
+    for elem in iter_renderer_children(context, renderer):
+        if elem.tag == 'symbol':
+            process_symbol(elem, out)
+            return
+
+def process_symbol(symbol, out):
+    layer = symbol.find('.//layer')
     if symbol.attrib['type'] == 'fill':
         # color -> polygon-fill
         color = get_prop_color(layer, 'color')
-        print('    polygon-fill: {0};'.format(color))
+        print('    polygon-fill: {0};'.format(color), file=out)
 
         # color_border -> line-color
         color_border = get_prop_color(layer, 'color_border')
-        print('    line-color: {0};'.format(color_border))
+        print('    line-color: {0};'.format(color_border), file=out)
 
         # width_border -> line-width
         width = get_prop(layer, 'width-border')
         if width:
-            print('    line-width: {0};'.format(width))
+            print('    line-width: {0};'.format(width), file=out)
 
     if symbol.attrib['type'] == 'line':
         # color -> line-color
         color = get_prop_color(layer, 'color')
-        print('    line-color: {0};'.format(color))
+        print('    line-color: {0};'.format(color), file=out)
 
         # width -> line-width
         width = get_prop(layer, 'width')
         if width:
-            print('    line-width: {0};'.format(width))
+            print('    line-width: {0};'.format(width), file=out)
 
         # penstyle -> line-dasharray
         penstyle = get_prop_penstyle(layer, 'penstyle')
         if penstyle and penstyle != 'none':
-            print('    line-dasharray: {0};'.format(penstyle))
+            print('    line-dasharray: {0};'.format(penstyle), file=out)
 
     if symbol.attrib['type'] == 'marker':
         # color -> marker-fill
         color = get_prop_color(layer, 'color')
-        print('    marker-fill: {0};'.format(color))
+        print('    marker-fill: {0};'.format(color), file=out)
 
         # color_border -> marker-line-color
         color_border = get_prop_color(layer, 'color_border')
-        print('    marker-line-color: {0};'.format(color_border))
+        print('    marker-line-color: {0};'.format(color_border), file=out)
 
         # size -> marker-width
         size = float(get_prop(layer, 'size')) * 5
-        print('    marker-width: {0};'.format(size))
+        print('    marker-width: {0};'.format(size), file=out)
 
 def get_prop(layer, prop):
     return find_layer_prop(layer, prop)
@@ -102,11 +130,8 @@ def get_prop_penstyle(layer, prop):
     return 'XXX'
 
 def find_layer_prop(layer, prop):
-    query = './/prop[@k="{0}"]'.format(prop)
-    results = layer.findall(query)
-    if not results:
-        return None
-    return results[0].attrib['v']
+    values = _PROP_XPATH(layer, k=prop)
+    return values[0] if values else None
 
 def main():
     process_file(sys.argv[1])
@@ -1,23 +1,34 @@
+import functools
+import gc
 import sys
 
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
 import matplotlib.transforms as mtransforms
 
+from matplotlib.collections import PolyCollection
+from matplotlib.colors import to_rgba_array
 from matplotlib.image import BboxImage
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 from matplotlib.path import Path
 from matplotlib_scalebar.scalebar import ScaleBar
-
-from descartes.patch import PolygonPatch
+from PIL import Image
 
 from cartopy.io.img_tiles import OSM
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-import geopandas as gpd
 import numpy
+import pyogrio
+import rasterio
+import rasterio.features
 import shapely
 
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+
 
 CONDITION_COLOR_MAP = {
     0: '#00441b',
@@ -46,6 +57,9 @@ HABITAT_CONDITION_COLOR_MAP = {
     (9, 10): '#265457',
 }
 
+HABITAT_CONDITION_BOUNDS = numpy.unique(list(HABITAT_CONDITION_COLOR_MAP))
+HABITAT_CONDITION_COLORS = numpy.array(list(HABITAT_CONDITION_COLOR_MAP.values()))
+
 HABITAT_COLUMN = 'BiodiversityCheck_H'
 CONDITION_COLUMN = 'Condition'
 HABITAT_CONDITION_COLUMN = 'Score_1to10'
@@ -55,10 +69,41 @@ BUFFER_Y = 200
 
 CONDITION_LEGEND_TITLE = 'Condition September 2023'
 
-OUTPUT_DPI = 600
+OUTPUT_DPI = 300
+
+# Either 'png', or 'geotiff' for tiled, WEBP compressed GeoTIFF maps with overviews.
+OUTPUT_FORMAT = 'png'
+
+GEOTIFF_OVERVIEW_FACTORS = [2, 4, 8, 16]
 
 OSM_LEVEL = 17
 
+# Render in this process and show each plot, rather than rendering in parallel processes.
+SHOW_PLOTS = False
+
+# Created once, so cartopy reuses its cached transforms rather than building a new pyproj CRS for each call.
+OSGB_CRS = ccrs.OSGB()
+
+OSM_CACHE_DIR = 'tile_cache'
+
+RENDER_FIGURE = 'render'
+
+BOUNDARY_SIMPLIFY_TOLERANCE = 0.5
+CONTOUR_SIMPLIFY_TOLERANCE = 1.0
+
+
+class CachedOSM(OSM):
+    '''OSM tile source that keeps fetched tiles in memory, so each map of the same
+    area reuses the tiles rather than downloading and decoding them again. Tiles
+    are also cached on disk (by cartopy) so they are reused between runs'''
+
+    @functools.lru_cache(maxsize=512)
+    def get_image(self, tile):
+        return super().get_image(tile)
+
+
+OSM_TILES = CachedOSM(desired_tile_form='L', cache=OSM_CACHE_DIR)
+
 
 def buffer_extents(extents, x_buffer, y_buffer):
     '''Buffer a bounding box in [x0, x1, y0, y1] format (matplotlib)'''
@@ -75,14 +120,101 @@ def transpose_bounds(bounds):
     return [bounds[0], bounds[2], bounds[1], bounds[3]]
 
 
-def get_color_for_condition(condition_score):
-    '''Get the color for the given condition score, defaulting to condition score 0'''
-    return CONDITION_COLOR_MAP.get(condition_score, CONDITION_COLOR_MAP[0])
+def fetch_osm_tiles(plot_bounds):
+    '''Fetch the OSM tiles for plot bounds in [x0, x1, y0, y1] format into the tile caches.
+    Render workers inherit (or load from disk) the caches, rather than each downloading
+    the same tiles'''
+    domain = OSM_TILES.crs.project_geometry(shapely.box(*transpose_bounds(plot_bounds)), OSGB_CRS)
+    OSM_TILES.image_for_domain(domain, OSM_LEVEL)
+
+
+def get_render_figure():
+    '''Get the figure to render into, reusing and clearing the same figure (and its
+    canvas) for every render rather than creating a new one each time'''
+    return plt.figure(num=RENDER_FIGURE, clear=True)
+
+
+def release_render_figure(fig):
+    '''Clear the render figure once it has been output, freeing its artists and their
+    image data straight away while keeping the figure for the next render'''
+    fig.clear()
+    gc.collect()
+
+
+def save_map(fig, ax, out_filename):
+    '''Save a map in the output format, either as a PNG or as a GeoTIFF of the map axes'''
+    if OUTPUT_FORMAT != 'geotiff':
+        fig.savefig(out_filename,
+                    bbox_inches='tight',
+                    pad_inches=0,
+                    dpi=OUTPUT_DPI)
+        return
+
+    # Draw the map at the output DPI and crop the canvas (origin top left) to the axes.
+    fig.set_dpi(OUTPUT_DPI)
+    fig.canvas.draw()
+    canvas_height = fig.canvas.get_width_height()[1]
+    x0, y0, x1, y1 = numpy.round(ax.bbox.extents).astype(int)
+    rgb = numpy.asarray(fig.canvas.buffer_rgba())[canvas_height - y1:canvas_height - y0, x0:x1, :3]
+
+    # Georeference the pixels to the map extent.
+    height, width = rgb.shape[:2]
+    extent_x0, extent_x1, extent_y0, extent_y1 = ax.get_extent(crs=OSGB_CRS)
+    transform = from_bounds(extent_x0, extent_y0, extent_x1, extent_y1, width, height)
+
+    with rasterio.open(out_filename, 'w',
+                       driver='GTiff',
+                       width=width,
+                       height=height,
+                       count=3,
+                       dtype='uint8',
+                       crs='EPSG:27700',
+                       transform=transform,
+                       tiled=True,
+                       blockxsize=256,
+                       blockysize=256,
+                       compress='WEBP') as dst:
+        dst.write(numpy.moveaxis(rgb, -1, 0))
+        dst.build_overviews(GEOTIFF_OVERVIEW_FACTORS, Resampling.average)
+
+
+def get_output_shape(ax):
+    '''Get the (width, height) in pixels of the axes at the output DPI'''
+    ax.apply_aspect()
+    width, height = ax.get_position().size * ax.figure.get_size_inches() * OUTPUT_DPI
+    return int(width), int(height)
+
+
+def get_regrid_shape(ax):
+    '''Get the basemap regrid shape matching the size of the axes at the output DPI'''
+    return min(get_output_shape(ax))
+
+
+def get_exterior_rings(geoms):
+    '''Get the exterior ring coordinates of every polygon part of the given geometries,
+    along with the index of the geometry each part belongs to'''
+    parts, part_index = shapely.get_parts(geoms, return_index=True)
+    exterior_rings = shapely.get_exterior_ring(parts)
+
+    # Drop any empty or non-polygon parts, which have no exterior ring coordinates.
+    has_ring = shapely.get_num_coordinates(exterior_rings) > 0
+    exterior_rings = exterior_rings[has_ring]
+
+    # Split the coordinates by the number in each ring.
+    coords, ring_index = shapely.get_coordinates(exterior_rings, return_index=True)
+    counts = numpy.bincount(ring_index, minlength=len(exterior_rings))
+    rings = numpy.split(coords, numpy.cumsum(counts)[:-1]) if len(counts) else []
+    return rings, part_index[has_ring]
+
+
+def get_colors_for_conditions(condition_scores):
+    '''Get the colors for a series of condition scores, defaulting to condition score 0'''
+    return condition_scores.map(CONDITION_COLOR_MAP).fillna(CONDITION_COLOR_MAP[0])
 
 
 def render_condition_map(hex_layer,
-                         boundary_layer,
-                         contour_layer,
+                         boundary_feature,
+                         contour_feature,
                          out_filename=None,
                          show_plot=False):
     '''Render the condition map'''
@@ -93,95 +225,135 @@ def render_condition_map(hex_layer,
     plot_bounds = buffer_extents(transpose_bounds(layer_bounds), BUFFER_X, BUFFER_Y)
 
     # Set up axes.
-    ax = plt.axes(projection=ccrs.OSGB())
-    ax.set_extent(plot_bounds, crs=ccrs.OSGB())
+    fig = get_render_figure()
+    ax = fig.add_subplot(1, 1, 1, projection=OSGB_CRS)
+    ax.set_extent(plot_bounds, crs=OSGB_CRS)
 
     # Add OSM layer to background.
-    osm = OSM(desired_tile_form='L')
-    ax.add_image(osm, OSM_LEVEL, cmap='gray', interpolation='spline36', regrid_shape=4000)
+    ax.add_image(OSM_TILES, OSM_LEVEL, cmap='gray', interpolation='spline36', regrid_shape=get_regrid_shape(ax))
 
     # Create list for legend layers.
     legend_layers = []
     legend_labels = []
 
-    # Add hexes.
-    for condition in hex_layer[CONDITION_COLUMN].unique():
-        hexes = hex_layer[hex_layer[CONDITION_COLUMN] == condition]
-        facecolor = get_color_for_condition(condition)
-
-        ax.add_geometries(hexes['geometry'],
-                          crs=hex_layer.crs,
-                          facecolor=facecolor,
-                          edgecolor="black",
-                          linestyle='-',
-                          linewidth=0.26)
-
+    # Add hexes as a single collection, splitting any multipolygons into their parts.
+    facecolors = get_colors_for_conditions(hex_layer[CONDITION_COLUMN]).to_numpy()
+    rings, index = get_exterior_rings(hex_layer.geometry.values)
+
+    hex_collection = PolyCollection(rings,
+                                    facecolors=facecolors[index],
+                                    edgecolors='black',
+                                    linestyle='-',
+                                    linewidths=0.26,
+                                    transform=OSGB_CRS,
+                                    rasterized=True)
+    ax.add_collection(hex_collection, autolim=False)
+
+    # Add a legend entry for each condition.
+    conditions = hex_layer[CONDITION_COLUMN].drop_duplicates()
+    for condition, facecolor in zip(conditions, get_colors_for_conditions(conditions)):
         legend_label = CONDITION_LABELS.get(condition)
         if legend_label:
             legend_layers.append(mpatches.Rectangle((0, 0), 1, 1, facecolor=facecolor))
             legend_labels.append(legend_label)
 
     # Add boundary.
-    boundary_geometries = list(boundary_layer.geometry)
-    boundary_feature = cfeature.ShapelyFeature(boundary_geometries,
-                                               crs=ccrs.OSGB(),
-                                               facecolor='none',
-                                               edgecolor='#d7191c',
-                                               linestyle="-",
-                                               linewidth=0.46,
-                                               zorder=3)
     ax.add_feature(boundary_feature)
 
     # Add contours.
-    contour_geometries = list(contour_layer.geometry)
-    contour_feature = cfeature.ShapelyFeature(contour_geometries,
-                                              crs=ccrs.OSGB(),
-                                              facecolor='none',
-                                              edgecolor='#bdbdbd',
-                                              linestyle="-",
-                                              linewidth=0.26,
-                                              alpha=0.5,
-                                              zorder=1)
-    ax.add_feature(contour_feature)
+    ax.add_feature(contour_feature).set_rasterized(True)
 
     # Add legend.
-    legend = plt.legend(handles=legend_layers, labels=legend_labels, loc='lower right', fontsize=5)
+    legend = ax.legend(handles=legend_layers, labels=legend_labels, loc='lower right', fontsize=5)
     legend.set_title(CONDITION_LEGEND_TITLE, prop={'size': 6})
 
     # Add Scalebar.
-    plt.gca().add_artist(ScaleBar(1.0, location='lower left', box_alpha=0, label_loc='right'))
+    ax.add_artist(ScaleBar(1.0, location='lower left', box_alpha=0, label_loc='right'))
 
     # Render plot to image.
     if out_filename is not None:
         print(f'Outputting condition map to {out_filename}')
-        plt.savefig(out_filename,
-                    bbox_inches='tight',
-                    pad_inches=0,
-                    dpi=OUTPUT_DPI)
+        save_map(fig, ax, out_filename)
 
     # Show plot.
     if show_plot:
         print('Showing plot')
         plt.show()
 
+    # Free the plot.
+    release_render_figure(fig)
 
+
+@functools.lru_cache(maxsize=64)
 def load_habitat_icon(habitat_name):
-    return plt.imread(f'style_files/habitats_symbology/{habitat_name}.png')
+    '''Load the icon for the given habitat as RGBA, caching it for subsequent renders'''
+    return Image.open(f'style_files/habitats_symbology/{habitat_name}.png').convert('RGBA')
+
+
+@functools.lru_cache(maxsize=64)
+def get_sized_habitat_icon(habitat_name, width, height):
+    '''Get the icon for the given habitat resized to width x height pixels, as a uint8 RGBA
+    array, caching it as most hexes share the same size'''
+    return numpy.asarray(load_habitat_icon(habitat_name).resize((width, height), Image.Resampling.LANCZOS))
+
+
+def draw_habitat_icons(habitat, hexes, plot_bounds, output_shape):
+    '''Draw the icon for a habitat into each of its hexes, fitted to the bounds of each hex,
+    on a single canvas at the output resolution, returning the canvas and its extent
+    (matplotlib)'''
+    # Get the pixel bounds of each hex on the output pixel grid of the plot bounds, so
+    # icons line up between habitats.
+    width, height = output_shape
+    x_scale = width / (plot_bounds[1] - plot_bounds[0])
+    y_scale = height / (plot_bounds[3] - plot_bounds[2])
+    hex_bounds = shapely.bounds(hexes.geometry.values)
+    cols = numpy.round((hex_bounds[:, [0, 2]] - plot_bounds[0]) * x_scale).astype(int)
+    rows = numpy.round((plot_bounds[3] - hex_bounds[:, [3, 1]]) * y_scale).astype(int)
+
+    # Only cover the extent of the habitat's hexes.
+    col0, row0 = cols.min(), rows.min()
+    cols -= col0
+    rows -= row0
+    canvas_width, canvas_height = cols.max(), rows.max()
+    extent = [
+        plot_bounds[0] + col0 / x_scale,
+        plot_bounds[0] + (col0 + canvas_width) / x_scale,
+        plot_bounds[3] - (row0 + canvas_height) / y_scale,
+        plot_bounds[3] - row0 / y_scale
+    ]
+
+    # Label the pixels of each hex, so icons only cover their own hex where the bounds of
+    # neighbouring hexes overlap.
+    labels = rasterio.features.rasterize(zip(hexes.geometry.values, numpy.arange(1, len(hexes) + 1)),
+                                         out_shape=(canvas_height, canvas_width),
+                                         transform=from_bounds(*transpose_bounds(extent),
+                                                               canvas_width,
+                                                               canvas_height),
+                                         fill=0,
+                                         all_touched=True,
+                                         dtype=numpy.uint32)
 
+    # Paste the icon into each hex.
+    canvas = numpy.zeros((canvas_height, canvas_width, 4), dtype=numpy.uint8)
+    for label, ((x0, x1), (y0, y1)) in enumerate(zip(cols, rows), start=1):
+        if x1 <= x0 or y1 <= y0:
+            continue
+        icon = get_sized_habitat_icon(habitat, x1 - x0, y1 - y0)
+        mask = labels[y0:y1, x0:x1] == label
+        canvas[y0:y1, x0:x1][mask] = icon[mask]
 
-def geom_to_path(geom):
-    # Convert MultiPolygon to Polygon
-    if geom.geom_type == 'MultiPolygon':
-        geom = geom.buffer(0)
+    return canvas, extent
 
-    # Get polygon coords and construct Path.
-    coords = geom.exterior.coords
-    return Path(coords)
+
+def geoms_to_path(geoms):
+    '''Convert polygons to a single compound Path of their exterior rings'''
+    rings, _ = get_exterior_rings(geoms)
+    return Path.make_compound_path(*[Path(ring) for ring in rings])
 
 
 def render_habitat_map(hex_layer,
-                       boundary_layer,
-                       contour_layer,
+                       boundary_feature,
+                       contour_feature,
                        out_filename=None,
                        show_plot=False):
     '''Render the habitat map'''
@@ -192,89 +364,61 @@ def render_habitat_map(hex_layer,
     plot_bounds = buffer_extents(transpose_bounds(layer_bounds), BUFFER_X, BUFFER_Y)
 
     # Set up axes.
-    ax = plt.axes(projection=ccrs.OSGB())
-    ax.set_extent(plot_bounds, crs=ccrs.OSGB())
+    fig = get_render_figure()
+    ax = fig.add_subplot(1, 1, 1, projection=OSGB_CRS)
+    ax.set_extent(plot_bounds, crs=OSGB_CRS)
 
     # Add OSM layer to background.
-    osm = OSM(desired_tile_form='L')
-    ax.add_image(osm, OSM_LEVEL, cmap='gray', interpolation='spline36', regrid_shape=4000)
+    ax.add_image(OSM_TILES, OSM_LEVEL, cmap='gray', interpolation='spline36', regrid_shape=get_regrid_shape(ax))
 
     # Add hexes.
-    for habitat in hex_layer[HABITAT_COLUMN].unique():
-        # Filter hexes to habitat.
-        hexes = hex_layer[hex_layer[HABITAT_COLUMN] == habitat]
-
-        # Load icon for habitat.
-        habitat_img = load_habitat_icon(habitat)
-
-        # Add icons.
-        for geom in hexes.geometry:
-            centroid = geom.centroid
+    output_shape = get_output_shape(ax)
+    for habitat, hexes in hex_layer.groupby(HABITAT_COLUMN, sort=False):
+        # Add icons as a single image of the habitat's hexes, with an icon fitted to each hex.
+        habitat_img, extent = draw_habitat_icons(habitat, hexes, plot_bounds, output_shape)
+        im = ax.imshow(habitat_img, extent=extent, interpolation='nearest', zorder=25)
 
-            # Get bounds of geometry to draw image to, and flip them from (x0, y0, x1, y1)
-            # to (x0, x1, y0, y1) for matplotlib.
-            bounds = geom.bounds
-            bounds = [bounds[0], bounds[2], bounds[1], bounds[3]]
-
-            # Add image.
-            im = ax.imshow(habitat_img, extent=bounds, zorder=25)
-
-            # Clip to geometry.
-            im.set_clip_path(geom_to_path(geom), transform=ax.transData)
+        # Clip to all geometries at once.
+        im.set_clip_path(geoms_to_path(hexes.geometry.values), transform=ax.transData)
 
     # Add boundary.
-    boundary_geometries = list(boundary_layer.geometry)
-    boundary_feature = cfeature.ShapelyFeature(boundary_geometries,
-                                               crs=ccrs.OSGB(),
-                                               facecolor='none',
-                                               edgecolor='#d7191c',
-                                               linestyle="-",
-                                               linewidth=0.46,
-                                               zorder=3)
     ax.add_feature(boundary_feature)
 
     # Add contours.
-    contour_geometries = list(contour_layer.geometry)
-    contour_feature = cfeature.ShapelyFeature(contour_geometries,
-                                              crs=ccrs.OSGB(),
-                                              facecolor='none',
-                                              edgecolor='#bdbdbd',
-                                              linestyle="-",
-                                              linewidth=0.26,
-                                              alpha=0.5,
-                                              zorder=1)
-    ax.add_feature(contour_feature)
+    ax.add_feature(contour_feature).set_rasterized(True)
 
     # Add Scalebar.
-    plt.gca().add_artist(ScaleBar(1.0, location='lower left', box_alpha=0, label_loc='right'))
+    ax.add_artist(ScaleBar(1.0, location='lower left', box_alpha=0, label_loc='right'))
 
     # Render plot to image.
     if out_filename is not None:
         print(f'Outputting habitat map to {out_filename}')
-        plt.savefig(out_filename,
-                    bbox_inches='tight',
-                    pad_inches=0,
-                    dpi=OUTPUT_DPI)
+        save_map(fig, ax, out_filename)
 
     # Show plot.
     if show_plot:
         print('Showing plot')
         plt.show()
 
+    # Free the plot.
+    release_render_figure(fig)
 
-def get_color_for_habitat_condition(score_1_to_10):
-    # Find the matching color for the given score.
-    for (min_score, max_score), color in HABITAT_CONDITION_COLOR_MAP.items():
-        if min_score < score_1_to_10 and score_1_to_10 <= max_score:
-            return color
 
-    # Return the last color by default if none match.
-    return color
+def get_color_index_for_habitat_condition(score_1_to_10):
+    '''Get the index into HABITAT_CONDITION_COLORS for the given score or array of scores,
+    where each color covers the scores in (min_score, max_score], defaulting to the last
+    color if none match'''
+    # Find the matching color for each score.
+    index = numpy.searchsorted(HABITAT_CONDITION_BOUNDS, score_1_to_10, side='left') - 1
+
+    # Use the last color by default if none match.
+    last_index = len(HABITAT_CONDITION_COLORS) - 1
+    return numpy.where((index < 0) | (index > last_index), last_index, index)
 
 
 def render_habitat_condition_map(hex_layer,
-                                 boundary_layer,
-                                 contour_layer,
+                                 boundary_feature,
+                                 contour_feature,
                                  out_filename=None,
                                  show_plot=False):
     '''Render the habitat condition map'''
@@ -285,64 +429,57 @@ def render_habitat_condition_map(hex_layer,
     plot_bounds = buffer_extents(transpose_bounds(layer_bounds), BUFFER_X, BUFFER_Y)
 
     # Set up axes.
-    ax = plt.axes(projection=ccrs.OSGB())
-    ax.set_extent(plot_bounds, crs=ccrs.OSGB())
+    fig = get_render_figure()
+    ax = fig.add_subplot(1, 1, 1, projection=OSGB_CRS)
+    ax.set_extent(plot_bounds, crs=OSGB_CRS)
 
     # Add OSM layer to background.
-    osm = OSM(desired_tile_form='L')
-    ax.add_image(osm, OSM_LEVEL, cmap='gray', interpolation='spline36', regrid_shape=4000)
-
-    # Add hexes.
-    for score_1_to_10 in hex_layer[HABITAT_CONDITION_COLUMN].unique():
-        hexes = hex_layer[hex_layer[HABITAT_CONDITION_COLUMN] == score_1_to_10]
-        facecolor = get_color_for_habitat_condition(score_1_to_10)
-
-        ax.add_geometries(hexes['geometry'],
-                          crs=hex_layer.crs,
-                          facecolor=facecolor,
-                          edgecolor='none',
-                          linestyle='-',
-                          linewidth=0.26)
+    ax.add_image(OSM_TILES, OSM_LEVEL, cmap='gray', interpolation='spline36', regrid_shape=get_regrid_shape(ax))
+
+    # Add hexes with a score. They have no outlines, so rasterize them straight to an image
+    # at the output resolution, with 0 left transparent and each color offset by 1.
+    hexes = hex_layer[hex_layer[HABITAT_CONDITION_COLUMN].notna()]
+    if not hexes.empty:
+        color_indexes = get_color_index_for_habitat_condition(hexes[HABITAT_CONDITION_COLUMN].to_numpy())
+
+        width, height = get_output_shape(ax)
+        hex_img = rasterio.features.rasterize(zip(hexes.geometry.values, color_indexes + 1),
+                                              out_shape=(height, width),
+                                              transform=from_bounds(*transpose_bounds(plot_bounds),
+                                                                    width,
+                                                                    height),
+                                              fill=0,
+                                              dtype=numpy.uint8)
+
+        color_lut = numpy.vstack([[0, 0, 0, 0], to_rgba_array(HABITAT_CONDITION_COLORS)])
+        ax.imshow(color_lut[hex_img],
+                  extent=plot_bounds,
+                  transform=OSGB_CRS,
+                  interpolation='nearest',
+                  zorder=1)
 
     # Add boundary.
-    boundary_geometries = list(boundary_layer.geometry)
-    boundary_feature = cfeature.ShapelyFeature(boundary_geometries,
-                                               crs=ccrs.OSGB(),
-                                               facecolor='none',
-                                               edgecolor='#d7191c',
-                                               linestyle="-",
-                                               linewidth=0.46,
-                                               zorder=3)
     ax.add_feature(boundary_feature)
 
     # Add contours.
-    contour_geometries = list(contour_layer.geometry)
-    contour_feature = cfeature.ShapelyFeature(contour_geometries,
-                                              crs=ccrs.OSGB(),
-                                              facecolor='none',
-                                              edgecolor='#bdbdbd',
-                                              linestyle="-",
-                                              linewidth=0.26,
-                                              alpha=0.5,
-                                              zorder=1)
-    ax.add_feature(contour_feature)
+    ax.add_feature(contour_feature).set_rasterized(True)
 
     # Add Scalebar.
-    plt.gca().add_artist(ScaleBar(1.0, location='lower left', box_alpha=0, label_loc='right'))
+    ax.add_artist(ScaleBar(1.0, location='lower left', box_alpha=0, label_loc='right'))
 
     # Render plot to image.
     if out_filename is not None:
         print(f'Outputting habitat map to {out_filename}')
-        plt.savefig(out_filename,
-                    bbox_inches='tight',
-                    pad_inches=0,
-                    dpi=OUTPUT_DPI)
+        save_map(fig, ax, out_filename)
 
     # Show plot.
     if show_plot:
         print('Showing plot')
         plt.show()
 
+    # Free the plot.
+    release_render_figure(fig)
+
 
 def render_habitat_condition_graph(hex_layer,
                                    out_filename=None,
@@ -350,24 +487,24 @@ def render_habitat_condition_graph(hex_layer,
     '''Render the habitat condition graph'''
     print('Rendering habitat condition graph...')
 
-    # Calculate the area in hectares for a score range.
-    def calculate_area_for_score_range(min_score, max_score):
-        # Get the rows in range.
-        rows_in_range = hex_layer[HABITAT_CONDITION_COLUMN] \
-            .between(min_score, max_score, inclusive='right')
-
-        # Calculate the area of all the hexes.
-        area = hex_layer[rows_in_range].geometry.area.sum()
+    # Calculate the area in hectares for each score range in a single pass, where each
+    # range covers the scores in (min_score, max_score].
+    def calculate_area_for_score_ranges():
+        # Get the range for each hex, ignoring hexes outside all ranges.
+        ranges = numpy.searchsorted(HABITAT_CONDITION_BOUNDS,
+                                    hex_layer[HABITAT_CONDITION_COLUMN].to_numpy(),
+                                    side='left') - 1
+        in_range = (ranges >= 0) & (ranges < len(HABITAT_CONDITION_COLORS))
+
+        # Sum the area of the hexes in each range.
+        areas = hex_layer.geometry.area.to_numpy()
+        area = numpy.bincount(ranges[in_range],
+                              weights=areas[in_range],
+                              minlength=len(HABITAT_CONDITION_COLORS))
 
         # Convert to hectares.
         return area / 10000.0
 
-    # Calculate each bar area_ha and color.
-    def get_area_and_color(key_value):
-        (min_score, max_score), color = key_value
-        area_ha = calculate_area_for_score_range(min_score, max_score)
-        return (max_score, area_ha, color)
-
     # Format hectares value to string.
     def format_hectares(area_ha):
         if area_ha < 10:
@@ -376,11 +513,16 @@ def render_habitat_condition_graph(hex_layer,
             return f'{area_ha:.1f} ha'
 
     # Pre-calculate bars.
-    bars = list(map(get_area_and_color, HABITAT_CONDITION_COLOR_MAP.items()))
+    bars = [
+        (max_score, area_ha, color)
+        for ((min_score, max_score), color), area_ha
+        in zip(HABITAT_CONDITION_COLOR_MAP.items(), calculate_area_for_score_ranges())
+    ]
     max_area = max(map(lambda x: x[1], bars))
 
     # Start the chart.
-    fig, ax = plt.subplots()
+    fig = get_render_figure()
+    ax = fig.add_subplot()
 
     ax.axis('off')
     ax.spines['top'].set_visible(False)
@@ -416,7 +558,7 @@ def render_habitat_condition_graph(hex_layer,
     # Render plot to image.
     if out_filename is not None:
         print(f'Outputting habitat condition graph to {out_filename}')
-        plt.savefig(out_filename,
+        fig.savefig(out_filename,
                     bbox_inches='tight',
                     pad_inches=0,
                     dpi=OUTPUT_DPI)
@@ -425,34 +567,90 @@ def render_habitat_condition_graph(hex_layer,
     if show_plot:
         plt.show()
 
+    # Free the plot.
+    release_render_figure(fig)
+
 
 def main():
-    # Load in files.
-    hex_layer = gpd.read_file('data/Final_shapefile.gpkg', engine='pyogrio')
-    boundary_layer = gpd.read_file('./data/Royal Alexandra & Albert School.shp', engine='pyogrio')
-    contour_layer = gpd.read_file('./data/contours.gpkg', boundary_layer, engine='pyogrio')
-
-    render_condition_map(hex_layer,
-                         boundary_layer,
-                         contour_layer,
-                         out_filename='condition_map.png',
-                         show_plot=False)
-
-    render_habitat_map(hex_layer,
-                       boundary_layer,
-                       contour_layer,
-                       out_filename='habitat_map.png',
-                       show_plot=False)
-
-    render_habitat_condition_map(hex_layer,
-                                 boundary_layer,
-                                 contour_layer,
-                                 out_filename='habitat_condition.png',
-                                 show_plot=False)
-
-    render_habitat_condition_graph(hex_layer,
-                                   out_filename='habitat_condition_graph.png',
-                                   show_plot=False)
+    # Load in files through Arrow, only reading the columns that are rendered.
+    hex_layer = pyogrio.read_dataframe('data/Final_shapefile.gpkg',
+                                       columns=[HABITAT_COLUMN,
+                                                CONDITION_COLUMN,
+                                                HABITAT_CONDITION_COLUMN],
+                                       use_arrow=True)
+    boundary_layer = pyogrio.read_dataframe('./data/Royal Alexandra & Albert School.shp',
+                                            use_arrow=True)
+
+    # Only read contours within the bounds of the boundary, in the CRS of the contours.
+    contour_crs = pyogrio.read_info('./data/contours.gpkg')['crs']
+    contour_layer = pyogrio.read_dataframe('./data/contours.gpkg',
+                                           bbox=tuple(boundary_layer.to_crs(contour_crs).total_bounds),
+                                           use_arrow=True)
+
+    # Simplify the outline layers, removing detail too small to see on the maps.
+    boundary_layer['geometry'] = boundary_layer.simplify(BOUNDARY_SIMPLIFY_TOLERANCE)
+    contour_layer['geometry'] = contour_layer.simplify(CONTOUR_SIMPLIFY_TOLERANCE,
+                                                       preserve_topology=False)
+
+    # Create the boundary and contour features once for all maps.
+    boundary_feature = cfeature.ShapelyFeature(boundary_layer.geometry.values,
+                                               crs=OSGB_CRS,
+                                               facecolor='none',
+                                               edgecolor='#d7191c',
+                                               linestyle="-",
+                                               linewidth=0.46,
+                                               zorder=3)
+
+    contour_feature = cfeature.ShapelyFeature(contour_layer.geometry.values,
+                                              crs=OSGB_CRS,
+                                              facecolor='none',
+                                              edgecolor='#bdbdbd',
+                                              linestyle="-",
+                                              linewidth=0.26,
+                                              alpha=0.5,
+                                              zorder=1)
+
+    # Fetch the basemap tiles for the plot bounds (as in the render functions) once, before
+    # the maps are rendered.
+    plot_bounds = buffer_extents(transpose_bounds(hex_layer.total_bounds), BUFFER_X, BUFFER_Y)
+    fetch_osm_tiles(plot_bounds)
+
+    # Get the file extension for the map output format.
+    map_extension = 'tif' if OUTPUT_FORMAT == 'geotiff' else 'png'
+
+    # Set up each render.
+    renders = [
+        (render_condition_map, (hex_layer,
+                                boundary_feature,
+                                contour_feature,
+                                f'condition_map.{map_extension}')),
+
+        (render_habitat_map, (hex_layer,
+                              boundary_feature,
+                              contour_feature,
+                              f'habitat_map.{map_extension}')),
+
+        (render_habitat_condition_map, (hex_layer,
+                                        boundary_feature,
+                                        contour_feature,
+                                        f'habitat_condition.{map_extension}')),
+
+        (render_habitat_condition_graph, (hex_layer,
+                                          'habitat_condition_graph.png')),
+    ]
+
+    if SHOW_PLOTS:
+        # Render each output in turn, showing each plot.
+        for render, args in renders:
+            render(*args, show_plot=True)
+    else:
+        # Render each output in its own process, using the non-interactive Agg backend.
+        with ProcessPoolExecutor(initializer=matplotlib.use, initargs=('Agg',)) as executor:
+            futures = [executor.submit(render, *args) for render, args in renders]
+
+            # Wait for all renders, raising any errors.
+            for future in futures:
+                future.result()
 
     print('Done!')
 